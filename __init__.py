@@ -1,15 +1,24 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
+from . import ir
 from . import production
 from . import bom
 
 
 def register():
     Pool.register(
+        ir.Cron,
         bom.BOMInput,
         production.Configuration,
         production.ConfigurationCompany,
         production.Production,
+        production.CreateMissingOutputLotsStart,
+        production.CreateMissingOutputLotsDone,
         production.StockMove,
+        production.Lot,
+        production.LotGenealogy,
         module='production_output_lot', type_='model')
+    Pool.register(
+        production.CreateMissingOutputLots,
+        module='production_output_lot', type_='wizard')
@@ -1,26 +1,86 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-from trytond.model import fields
+from sql import Literal
+from sql.aggregate import Count
+
+from trytond.cache import Cache
+from trytond.model import Index, fields
 from trytond.pool import PoolMeta
 from trytond.i18n import gettext
 from trytond.model.exceptions import ValidationError
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 
 
 class BOMInput(metaclass=PoolMeta):
     __name__ = 'production.bom.input'
     use_lot = fields.Boolean('Use Lot')
+    _drag_lot_product_cache = Cache(
+        'production.bom.input.drag_lot_product', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.bom, Index.Range()), where=t.use_lot))
+
+    @classmethod
+    def on_modification(cls, mode, inputs, field_names=None):
+        super().on_modification(mode, inputs, field_names=field_names)
+        cls._drag_lot_product_cache.clear()
+
+    @classmethod
+    def get_drag_lot_products(cls, bom_ids):
+        '''
+        Return the product id of the use lot input of each BOM or None.
+        The BOMs missing from the cache are read with one query per slice.
+        '''
+        products, missing = {}, []
+        for bom_id in bom_ids:
+            product_id = cls._drag_lot_product_cache.get(bom_id, -1)
+            if product_id == -1:
+                missing.append(bom_id)
+            else:
+                products[bom_id] = product_id
+
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        for sub_ids in grouped_slice(missing):
+            sub_ids = list(sub_ids)
+            products.update(dict.fromkeys(sub_ids))
+            cursor.execute(*table.select(table.bom, table.product,
+                    where=reduce_ids(table.bom, sub_ids)
+                    & (table.use_lot == Literal(True)),
+                    order_by=[table.id.desc]))
+            # Ordered so the first created input wins
+            products.update(cursor)
+            for bom_id in sub_ids:
+                cls._drag_lot_product_cache.set(bom_id, products[bom_id])
+        return products
 
     @classmethod
     def validate(cls, boms):
         super().validate(boms)
-        for bom in boms:
-            bom.check_unique_use_lot_in_bom()
+        cls.check_unique_use_lot_in_boms(boms)
 
     def check_unique_use_lot_in_bom(self):
-        inputs = self.search([
-            ('bom', '=', self.bom.id),
-            ('use_lot', '=', True)
-            ])
-        if len(inputs) > 1:
-            raise ValidationError(
-                gettext('production_output_lot.unique_use_lot_in_bom'))
+        self.check_unique_use_lot_in_boms([self])
+
+    @classmethod
+    def check_unique_use_lot_in_boms(cls, inputs):
+        'Check with one query per slice that each BOM has one use lot input'
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        bom_ids = {i.bom.id for i in inputs}
+        for sub_ids in grouped_slice(bom_ids):
+            cursor.execute(*table.select(table.bom,
+                    where=reduce_ids(table.bom, sub_ids)
+                    & (table.use_lot == Literal(True)),
+                    group_by=table.bom,
+                    having=Count(Literal('*')) > 1,
+                    limit=1))
+            if cursor.fetchone():
+                raise ValidationError(
+                    gettext('production_output_lot.unique_use_lot_in_bom'))
@@ -0,0 +1,155 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def _counters():
+    if not hasattr(_local, 'counters'):
+        _local.counters = []
+    return _local.counters
+
+
+class QueryCounter:
+    '''
+    Count the SQL queries executed on the connection of the current
+    transaction, without changing the logging of the other threads.
+    Counters can be nested, each one counts the queries run in its block.
+    '''
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        counters = _counters()
+        if not counters:
+            self._install()
+        counters.append(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        counters = _counters()
+        counters.remove(self)
+        if not counters:
+            self._uninstall()
+
+    @classmethod
+    def _increment(cls, *args):
+        for counter in _counters():
+            counter.count += 1
+
+    def _install(self):
+        connection = Transaction().connection
+        _local.connection = connection
+        if hasattr(connection, 'set_trace_callback'):
+            connection.set_trace_callback(self._increment)
+        elif hasattr(connection, 'cursor_factory'):
+            # Only the cursors of this connection are counted
+            _local.cursor_factory = connection.cursor_factory
+            connection.cursor_factory = _counting_cursor(
+                connection.cursor_factory)
+
+    def _uninstall(self):
+        connection = getattr(_local, 'connection', None)
+        if connection is None:
+            return
+        if hasattr(connection, 'set_trace_callback'):
+            sqlite_logger = logging.getLogger(
+                'trytond.backend.sqlite.database')
+            connection.set_trace_callback(sqlite_logger.debug
+                if sqlite_logger.isEnabledFor(logging.DEBUG) else None)
+        elif getattr(_local, 'cursor_factory', None) is not None:
+            connection.cursor_factory = _local.cursor_factory
+            _local.cursor_factory = None
+        _local.connection = None
+
+
+_counting_cursors = {}
+
+
+def _counting_cursor(factory):
+    'Return a subclass of the cursor factory counting the executed queries'
+    if factory not in _counting_cursors:
+        class CountingCursor(factory):
+            def execute(self, *args, **kwargs):
+                QueryCounter._increment()
+                return super().execute(*args, **kwargs)
+
+            def executemany(self, *args, **kwargs):
+                QueryCounter._increment()
+                return super().executemany(*args, **kwargs)
+        _counting_cursors[factory] = CountingCursor
+    return _counting_cursors[factory]
+
+
+class OutputLotProfiler:
+    '''
+    Record the time and the number of queries of each phase of the output lot
+    creation.
+    It is enabled by the "profile" option of the "production_output_lot"
+    configuration section or by the "output_lot_profile" context key.
+    The summary is logged with the "output_lot_profile" extra attribute.
+    '''
+
+    def __init__(self, name, count=0):
+        self.name = name
+        self.count = count
+        self.phases = defaultdict(lambda: {'time': 0., 'queries': 0})
+
+    @classmethod
+    def enabled(cls):
+        return bool(Transaction().context.get('output_lot_profile')
+            or config.getboolean(
+                'production_output_lot', 'profile', default=False))
+
+    @classmethod
+    def get(cls, name, count=0):
+        'Return a profiler or None if profiling is not enabled'
+        if cls.enabled():
+            return cls(name, count=count)
+
+    @contextmanager
+    def _phase(self, name):
+        start = time.perf_counter()
+        with QueryCounter() as counter:
+            try:
+                yield
+            finally:
+                phase = self.phases[name]
+                phase['time'] += time.perf_counter() - start
+                phase['queries'] += counter.count
+
+    def summary(self):
+        return {
+            'name': self.name,
+            'count': self.count,
+            'time': sum(p['time'] for p in self.phases.values()),
+            'queries': sum(p['queries'] for p in self.phases.values()),
+            'phases': dict(self.phases),
+            }
+
+    def log(self):
+        summary = self.summary()
+        logger.info('%s of %s productions: %.3fs, %s queries (%s)',
+            summary['name'], summary['count'], summary['time'],
+            summary['queries'], ', '.join(
+                '%s: %.3fs %s queries' % (n, p['time'], p['queries'])
+                for n, p in summary['phases'].items()),
+            extra={'output_lot_profile': summary})
+
+
+def phase(profiler, name):
+    'Return a context manager measuring the phase when profiler is set'
+    if profiler is None:
+        return nullcontext()
+    return profiler._phase(name)
@@ -0,0 +1,18 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+__all__ = ['Cron']
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('production|create_missing_output_lots',
+                "Create Missing Output Lots"))
+        cls.method.selection.append(
+            ('stock.lot.genealogy|populate', "Populate Lot Genealogy"))
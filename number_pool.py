@@ -0,0 +1,144 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import threading
+from collections import deque
+
+from trytond import backend
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction, TransactionError
+
+logger = logging.getLogger(__name__)
+
+
+class _Block:
+    __slots__ = ('numbers', 'end')
+
+    def __init__(self):
+        self.numbers = deque()
+        self.end = None
+
+
+class LotNumberPool:
+    '''
+    Lot numbers claimed by blocks from the sequences and handed out locally.
+
+    The size of the blocks is set by the "number_pool_size" option of the
+    "production_output_lot" configuration section (0 disables the pool).
+    Each block is claimed in its own short transaction so the sequence row is
+    not locked until the end of the transaction using the numbers.
+    The numbers are not contiguous between workers and the numbers not used
+    when a worker stops are lost unless release is called by the shutdown hook
+    of the worker (e.g. the worker exit hook of the WSGI server) while the
+    database is still reachable.
+    The numbers of the sequences drawn from a SQL sequence (e.g. on
+    PostgreSQL) are never given back because nextval does not wait for the
+    lock of the sequence so the rewind could hand out the numbers drawn
+    meanwhile by other transactions.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocks = {}
+
+    @staticmethod
+    def size():
+        return config.getint(
+            'production_output_lot', 'number_pool_size', default=0)
+
+    def enabled(self, sequence):
+        # SQLite uses a single connection so a block can not be committed
+        # independently of the current transaction
+        return (self.size() > 0
+            and backend.name != 'sqlite'
+            and sequence.__name__ == 'ir.sequence')
+
+    def take(self, sequence, count):
+        'Return count numbers of the sequence from the pool'
+        key = (Transaction().database.name, sequence.id)
+        with self._lock:
+            block = self._blocks.setdefault(key, _Block())
+            if len(block.numbers) < count:
+                numbers, block.end = self._claim(
+                    sequence, max(self.size(), count - len(block.numbers)))
+                block.numbers.extend(numbers)
+            # The remaining numbers are always the tail of the last claim
+            return [block.numbers.popleft() for _ in range(count)]
+
+    def _claim(self, sequence, count):
+        'Draw count numbers in a committed transaction'
+        pool = Pool()
+        Sequence = pool.get('ir.sequence')
+        with Transaction().new_transaction() as transaction:
+            numbers, end = self._draw(Sequence(sequence.id), count)
+            transaction.commit()
+        logger.debug('claim %s numbers of sequence %s', count, sequence.id)
+        return numbers, end
+
+    @staticmethod
+    def _draw(sequence, count):
+        '''
+        Return count numbers of the sequence and its next number after them
+        or None if they can not be given back
+        '''
+        if (sequence.type != 'incremental'
+                or Transaction().database.has_sequence()):
+            return list(sequence.get_many(n=count)), None
+        # The end is computed from the claimed range as other transactions
+        # may draw numbers once the lock is released
+        sequence.lock()
+        start = sequence.number_next_internal
+        numbers = list(sequence.get_many(n=count))
+        return numbers, start + count * sequence.number_increment
+
+    def release(self):
+        '''
+        Give the unused numbers back to their sequence when no other number
+        has been drawn after them and the sequence is not a SQL sequence.
+        It must be called explicitly, outside of any transaction, before the
+        worker stops.
+        '''
+        with self._lock:
+            blocks, self._blocks = self._blocks, {}
+        for (database_name, sequence_id), block in blocks.items():
+            if block.numbers and block.end is not None:
+                self._release(database_name, sequence_id, block)
+
+    def _release(self, database_name, sequence_id, block):
+        extras = {}
+        while True:
+            with Transaction().start(
+                    database_name, 0, **extras) as transaction:
+                pool = Pool()
+                Sequence = pool.get('ir.sequence')
+                try:
+                    if self._give_back(Sequence(sequence_id), block):
+                        transaction.commit()
+                except TransactionError as e:
+                    transaction.rollback()
+                    e.fix(extras)
+                    continue
+                return
+
+    @staticmethod
+    def _give_back(sequence, block):
+        '''
+        Rewind the sequence by the unused numbers of the block if no number
+        has been drawn since the block was claimed and return if it has been
+        rewound
+        '''
+        pool = Pool()
+        Sequence = pool.get('ir.sequence')
+        sequence.lock()
+        if sequence.number_next_internal != block.end:
+            return False
+        Sequence.write([sequence], {
+                'number_next': block.end - (
+                    len(block.numbers) * sequence.number_increment),
+                })
+        block.numbers.clear()
+        return True
+
+
+number_pool = LotNumberPool()
@@ -1,22 +1,97 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from trytond.model import ModelSQL, fields
+import logging
+from collections import defaultdict, namedtuple
+
+from sql import For, Literal, Null, With
+from sql.aggregate import Count
+from sql.functions import CurrentTimestamp
+from sql.operators import Exists
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import Index, ModelSQL, ModelView, Unique, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Id
+from trytond.rpc import RPC
 from trytond.modules.company.model import CompanyValueMixin
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction, TransactionError
+from trytond.wizard import Button, StateTransition, StateView, Wizard
+
+from .instrumentation import OutputLotProfiler, phase
+from .number_pool import number_pool
 
-__all__ = ['Configuration', 'ConfigurationCompany', 'Production', 'StockMove']
+logger = logging.getLogger(__name__)
+
+__all__ = ['Configuration', 'ConfigurationCompany', 'Production',
+    'CreateMissingOutputLotsStart', 'CreateMissingOutputLotsDone',
+    'CreateMissingOutputLots', 'StockMove', 'Lot', 'LotGenealogy']
 
 _OUTPUT_LOT_CREATION = [
     ('running', 'Production in Running'),
+    ('running_deferred', 'Production in Running (Deferred)'),
     ('done', 'Production is Done'),
     ]
 
+_MISSING = object()
+
+# The states of the outputs which can still get a lot
+_OUTPUT_LOT_STATES = ['staging', 'draft', 'assigned']
+
+OutputLotSettings = namedtuple('OutputLotSettings',
+    ['creation', 'sequence', 'reuse_drag_lot'])
+
+
+class OutputLotPlan:
+    '''
+    The lot planned for an output move.
+    lot is the id of the lot to assign once it is known and source is the
+    plan creating the new lot shared with this output.
+    '''
+    __slots__ = ('move', 'product', 'number', 'drag_lot', 'lot', 'source',
+        'expiration_date', 'shelf_life_expiration_date')
+
+    def __init__(self, move, product, number, drag_lot=None):
+        self.move = move
+        self.product = product
+        self.number = number
+        self.drag_lot = drag_lot
+        self.lot = None
+        self.source = None
+        self.expiration_date = None
+        self.shelf_life_expiration_date = None
+
+    def __repr__(self):
+        return 'OutputLotPlan(%s)' % ', '.join(
+            '%s=%r' % (n, getattr(self, n)) for n in self.__slots__
+            if n != 'source')
+
+    @property
+    def lot_id(self):
+        if self.source is not None:
+            return self.source.lot
+        return self.lot
+
+    def lot_values(self):
+        'Return the values to create the lot'
+        values = {
+            'product': self.product,
+            'number': self.number,
+            }
+        for name in ['expiration_date', 'shelf_life_expiration_date']:
+            if getattr(self, name) is not None:
+                values[name] = getattr(self, name)
+        return values
+
 
 class Configuration(metaclass=PoolMeta):
     __name__ = 'production.configuration'
+    _output_lot_settings_cache = Cache(
+        'production.configuration.output_lot_settings', context=False)
 
     output_lot_creation = fields.MultiValue(fields.Selection(
             _OUTPUT_LOT_CREATION, 'When Output Lot is created?', required=True,
@@ -30,11 +105,16 @@ class Configuration(metaclass=PoolMeta):
                 ('sequence_type', '=', Id('stock_lot',
                         'sequence_type_stock_lot')),
                 ]))
+    output_lot_reuse_drag_lot = fields.MultiValue(fields.Boolean(
+            'Reuse Dragged Output Lot',
+            help='Reuse the existing output lot with the number of the input '
+            'lot instead of creating a new lot for each output.'))
 
     @classmethod
     def multivalue_model(cls, field):
         pool = Pool()
-        if field in {'output_lot_creation', 'output_lot_sequence'}:
+        if field in {'output_lot_creation', 'output_lot_sequence',
+                'output_lot_reuse_drag_lot'}:
             return pool.get('production.configuration.company')
         return super(Configuration, cls).multivalue_model(field)
 
@@ -43,6 +123,30 @@ class Configuration(metaclass=PoolMeta):
         return cls.multivalue_model(
             'output_lot_creation').default_output_lot_creation()
 
+    @classmethod
+    def get_output_lot_settings(cls, company=None):
+        '''
+        Return the output lot settings of the company, or of the company of
+        the context.
+        '''
+        pool = Pool()
+        Sequence = pool.get('ir.sequence')
+        if company is None:
+            company = Transaction().context.get('company')
+        values = cls._output_lot_settings_cache.get(company)
+        if values is None:
+            with Transaction().set_context(company=company):
+                config = cls(1)
+                sequence = config.output_lot_sequence
+                values = (config.output_lot_creation,
+                    sequence.id if sequence else None,
+                    bool(config.output_lot_reuse_drag_lot))
+            cls._output_lot_settings_cache.set(company, values)
+        creation, sequence_id, reuse_drag_lot = values
+        return OutputLotSettings(creation,
+            Sequence(sequence_id) if sequence_id is not None else None,
+            reuse_drag_lot)
+
 
 class ConfigurationCompany(ModelSQL, CompanyValueMixin):
     'Production Configuration by Company'
@@ -56,115 +160,1091 @@ class ConfigurationCompany(ModelSQL, CompanyValueMixin):
             ('sequence_type', '=', Id('stock_lot',
                     'sequence_type_stock_lot')),
             ])
+    output_lot_reuse_drag_lot = fields.Boolean('Reuse Dragged Output Lot')
 
     @classmethod
     def default_output_lot_creation(cls):
         return 'running'
 
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Config = pool.get('production.configuration')
+        super().on_modification(mode, records, field_names=field_names)
+        Config._output_lot_settings_cache.clear()
+
 
 class Production(metaclass=PoolMeta):
     __name__ = 'production'
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.__rpc__.update({
+                'preview_output_lots': RPC(readonly=True, instantiate=0),
+                'process_with_output_lots': RPC(
+                    readonly=False, instantiate=0),
+                'run_by_chunks': RPC(readonly=False, instantiate=0),
+                'do_by_chunks': RPC(readonly=False, instantiate=0),
+                })
+
     @classmethod
     def run(cls, productions):
-        pool = Pool()
-        Config = pool.get('production.configuration')
-        config = Config(1)
-        if not config.output_lot_creation:
-            raise UserError(gettext(
-                'production_output_lot.missing_output_lot_creation_config'))
+        profiler = OutputLotProfiler.get('run', len(productions))
+        with phase(profiler, 'config'):
+            groups = cls._get_output_lot_groups(productions)
+        with phase(profiler, 'filter'):
+            groups = cls._filter_output_lot_groups(groups,
+                {'running', 'running_deferred'})
+        with phase(profiler, 'check'):
+            cls.check_output_lot_inputs(
+                [p for _, c_productions, _ in groups for p in c_productions])
 
-        super(Production, cls).run(productions)
-        if config.output_lot_creation == 'running':
-            for production in productions:
-                production.create_output_lots()
+        with phase(profiler, 'workflow'):
+            super(Production, cls).run(productions)
+        for company, company_productions, settings in groups:
+            with Transaction().set_context(company=company):
+                if settings.creation == 'running':
+                    cls.assign_output_lots(company_productions,
+                        settings=settings, profiler=profiler, filtered=True)
+                elif settings.creation == 'running_deferred':
+                    with Transaction().set_context(queue_batch=True):
+                        cls.__queue__.create_output_lots_deferred(
+                            company_productions)
+        if profiler:
+            profiler.log()
 
     @classmethod
     def do(cls, productions):
+        profiler = OutputLotProfiler.get('do', len(productions))
+        with phase(profiler, 'config'):
+            groups = cls._get_output_lot_groups(productions)
+        with phase(profiler, 'filter'):
+            # The deferred task may not have been run yet
+            groups = cls._filter_output_lot_groups(groups,
+                {'done', 'running_deferred'})
+        with phase(profiler, 'check'):
+            cls.check_output_lot_inputs(
+                [p for _, c_productions, _ in groups for p in c_productions])
+
+        for company, company_productions, settings in groups:
+            with Transaction().set_context(company=company):
+                cls.assign_output_lots(company_productions,
+                    settings=settings, profiler=profiler, filtered=True)
+        with phase(profiler, 'workflow'):
+            super(Production, cls).do(productions)
+        if profiler:
+            profiler.log()
+
+    @classmethod
+    def process_with_output_lots(cls, productions, transition):
+        '''
+        Run or do the productions depending on transition and return the lots
+        of all their outputs as a dictionary of output move id (as string to
+        be marshallable): (lot id, number, expiration date).
+        The lots created by the call as well as those assigned before are
+        returned but not those left to the queue by the "running_deferred"
+        creation.
+        '''
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+        transitions = {
+            'run': cls.run,
+            'do': cls.do,
+            }
+        if transition not in transitions:
+            raise UserError(gettext(
+                    'production_output_lot.invalid_transition',
+                    transition=transition))
+        transitions[transition](productions)
+        outputs = Move.search([
+                ('production_output', 'in', [p.id for p in productions]),
+                ('lot', '!=', None),
+                ], order=[('id', 'ASC')])
+        has_expiration = hasattr(Lot, 'expiration_date')
+        return {str(o.id): (o.lot.id, o.lot.number,
+                o.lot.expiration_date if has_expiration else None)
+            for o in outputs}
+
+    @classmethod
+    def _get_output_lot_groups(cls, productions):
+        '''
+        Return the productions grouped by company with the output lot settings
+        of their company as a list of (company id, productions, settings)
+        '''
         pool = Pool()
         Config = pool.get('production.configuration')
-        config = Config(1)
-        if not config.output_lot_creation:
+        company2productions = defaultdict(list)
+        for production in productions:
+            company2productions[production.company.id].append(production)
+        groups = []
+        for company, company_productions in sorted(
+                company2productions.items()):
+            settings = Config.get_output_lot_settings(company=company)
+            if not settings.creation:
+                raise UserError(gettext(
+                    'production_output_lot.missing_output_lot_creation_config'))
+            groups.append((company, company_productions, settings))
+        return groups
+
+    @classmethod
+    def _filter_output_lot_groups(cls, groups, creations):
+        '''
+        Return the groups whose output lot creation is in creations reduced to
+        the productions with outputs requiring a lot
+        '''
+        filtered = []
+        for company, company_productions, settings in groups:
+            if settings.creation not in creations:
+                continue
+            required = set(cls.filter_output_lot_required(
+                    [p.id for p in company_productions]))
+            company_productions = [
+                p for p in company_productions if p.id in required]
+            if company_productions:
+                filtered.append((company, company_productions, settings))
+        return filtered
+
+    @classmethod
+    def filter_output_lot_required(cls, production_ids):
+        '''
+        Return the ids of the productions which have outputs, neither done nor
+        cancelled, without lot whose product requires one, in the same order.
+        The outputs are read with one query per slice without instantiating
+        them and the requirement is evaluated once per product and locations.
+        '''
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Product = pool.get('product.product')
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        required, result = {}, set()
+        for sub_ids in grouped_slice(production_ids):
+            cursor.execute(*move.select(
+                    move.production_output, move.product,
+                    move.from_location, move.to_location,
+                    where=reduce_ids(move.production_output, sub_ids)
+                    & (move.lot == Null)
+                    & move.state.in_(_OUTPUT_LOT_STATES),
+                    group_by=[move.production_output, move.product,
+                        move.from_location, move.to_location]))
+            for production_id, *key in cursor:
+                key = tuple(key)
+                if production_id in result:
+                    continue
+                if key not in required:
+                    product, from_location, to_location = key
+                    required[key] = Product(product).lot_is_required(
+                        Location(from_location), Location(to_location))
+                if required[key]:
+                    result.add(production_id)
+        return [i for i in production_ids if i in result]
+
+    @classmethod
+    def check_output_lot_inputs(cls, productions):
+        '''
+        Check that the productions whose BOM drags the lot of an input have
+        exactly one input move with a lot of that product.
+        The lot-bearing inputs are counted with one aggregated query per slice
+        so all the offending productions are reported before any write.
+        '''
+        pool = Pool()
+        BOMInput = pool.get('production.bom.input')
+        Move = pool.get('stock.move')
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        bom2product = BOMInput.get_drag_lot_products(
+            {p.bom.id for p in productions if p.bom})
+        production2product = {}
+        for production in productions:
+            if production.bom:
+                product_id = bom2product.get(production.bom.id)
+                if product_id is not None:
+                    production2product[production.id] = product_id
+        if not production2product:
+            return
+
+        counts = {}
+        products = list(set(production2product.values()))
+        for sub_ids in grouped_slice(list(production2product)):
+            cursor.execute(*move.select(
+                    move.production_input, move.product, Count(move.id),
+                    where=reduce_ids(move.production_input, sub_ids)
+                    & move.product.in_(products)
+                    & (move.lot != Null),
+                    group_by=[move.production_input, move.product]))
+            for production_id, product_id, count in cursor:
+                if production2product[production_id] == product_id:
+                    counts[production_id] = count
+
+        invalid = [p for p in productions
+            if p.id in production2product and counts.get(p.id) != 1]
+        if invalid:
             raise UserError(gettext(
-                'production_output_lot.missing_output_lot_creation_config'))
+                    'production_output_lot.invalid_input_lots',
+                    productions=', '.join(p.rec_name for p in invalid)))
+
+    @classmethod
+    def run_by_chunks(cls, productions, chunk_size=None):
+        '''
+        Run the productions by chunks of chunk_size (the "batch_size" option
+        of the "production_output_lot" configuration section by default), each
+        chunk being committed in its own transaction.
+        '''
+        cls._process_by_chunks_or_raise('run', productions, chunk_size)
+
+    @classmethod
+    def do_by_chunks(cls, productions, chunk_size=None):
+        '''
+        Do the productions by chunks of chunk_size (the "batch_size" option
+        of the "production_output_lot" configuration section by default), each
+        chunk being committed in its own transaction.
+        '''
+        cls._process_by_chunks_or_raise('do', productions, chunk_size)
+
+    @classmethod
+    def process_by_chunks(cls, method, productions, chunk_size,
+            results=None, **kwargs):
+        '''
+        Call the method on the productions by chunks of chunk_size with the
+        keyword arguments, each chunk being committed in its own transaction.
+        When a chunk fails, its productions are processed one by one so only
+        the faulty ones are left unprocessed. As the workflow transitions skip
+        the productions already processed, it can be called again with the
+        same productions to resume.
+        Return the ids of the processed productions and the error message of
+        the failed ones. The result of each successful call is appended to
+        results when it is set.
+        The user and database errors (like a lock not available) are reported
+        as failures, the other errors are raised.
+        '''
+        errors = (UserError, backend.DatabaseOperationalError,
+            backend.DatabaseIntegrityError)
+        chunks = [list(c)
+            for c in grouped_slice([p.id for p in productions], chunk_size)]
+        processed, failed = [], {}
+        for i, chunk in enumerate(chunks, 1):
+            try:
+                result = cls._process_chunk(method, chunk, kwargs)
+                processed.extend(chunk)
+                if results is not None:
+                    results.append(result)
+            except errors:
+                for id_ in chunk:
+                    try:
+                        result = cls._process_chunk(method, [id_], kwargs)
+                        processed.append(id_)
+                        if results is not None:
+                            results.append(result)
+                    except errors as e:
+                        failed[id_] = (e.message
+                            if isinstance(e, UserError) else str(e))
+            logger.info('%s chunk %s/%s: %s processed, %s failed',
+                method, i, len(chunks), len(processed), len(failed))
+        return processed, failed
+
+    @classmethod
+    def _process_chunk(cls, method, ids, kwargs):
+        transaction = Transaction()
+        extras = {}
+        while True:
+            with transaction.new_transaction(**extras) as chunk_transaction:
+                try:
+                    result = getattr(cls, method)(cls.browse(ids), **kwargs)
+                    chunk_transaction.commit()
+                except TransactionError as e:
+                    chunk_transaction.rollback()
+                    e.fix(extras)
+                    continue
+                return result
 
-        if config.output_lot_creation == 'done':
-            for production in productions:
-                production.create_output_lots()
-        super(Production, cls).do(productions)
+    @classmethod
+    def _process_by_chunks_or_raise(cls, method, productions, chunk_size):
+        if chunk_size is None:
+            chunk_size = config.getint(
+                'production_output_lot', 'batch_size', default=1000)
+        _, failed = cls.process_by_chunks(method, productions, chunk_size)
+        if failed:
+            raise UserError(gettext('production_output_lot.chunk_failures',
+                    productions='\n'.join(
+                        '%s: %s' % (cls(id_).rec_name, message)
+                        for id_, message in failed.items())))
+
+    @classmethod
+    def create_output_lots_deferred(cls, productions):
+        '''
+        Create the output lots of running productions from the queue.
+        Outputs with a lot are skipped so the task can be safely retried.
+        '''
+        productions = [p for p in productions if p.state == 'running']
+        # The outputs locked by a concurrent transaction will get their lot
+        # from it
+        cls.assign_output_lots(productions, skip_locked=True)
 
     def create_output_lots(self):
-        Config = Pool().get('production.configuration')
-        config = Config(1)
+        return self.create_output_lots_batch([self])
 
-        if not config.output_lot_creation or not config.output_lot_sequence:
-            raise UserError(gettext(
-                'production_output_lot.missing_output_lot_creation_config'))
-
-        created_lots = []
-        drag_lot = None
-
-        if self.bom:
-            products = [x for x in self.bom.inputs if x.use_lot == True]
-            if products:
-                product = products[0]
-                inputs = [x for x in self.inputs if x.lot
-                    and x.product == product.product]
-                if len(inputs) != 1:
+    @classmethod
+    def create_missing_output_lots(cls, chunk_size=None):
+        '''
+        Create the missing lots of the outputs of the running productions of
+        the company and return the number of lots created.
+        The productions are processed by chunks committed one by one so it can
+        be called again to resume. The outputs locked by another transaction
+        are skipped and left for the next call.
+        '''
+        if chunk_size is None:
+            chunk_size = config.getint(
+                'production_output_lot', 'batch_size', default=1000)
+        productions = cls.browse(cls._get_missing_output_lot_productions())
+        results = []
+        _, failed = cls.process_by_chunks(
+            'assign_output_lots', productions, chunk_size, results=results,
+            skip_locked=True, filtered=True)
+        for id_, message in failed.items():
+            logger.warning('fail to create output lots of production %s: %s',
+                id_, message)
+        return sum(len(r) for r in results)
+
+    @classmethod
+    def _get_missing_output_lot_productions(cls):
+        '''
+        Return the ids of the running productions of the company with outputs
+        requiring a lot without lot
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        production = cls.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        where = ((production.state == 'running')
+            & (move.lot == Null)
+            & move.state.in_(_OUTPUT_LOT_STATES))
+        company = Transaction().context.get('company')
+        if company:
+            where &= production.company == company
+        cursor.execute(*production.join(move,
+                condition=move.production_output == production.id
+                ).select(production.id,
+                where=where,
+                group_by=[production.id],
+                order_by=[production.id.asc]))
+        return cls.filter_output_lot_required([i for i, in cursor])
+
+    @classmethod
+    def create_output_lots_batch(cls, productions, settings=None,
+            profiler=None):
+        '''
+        Create the lots of all the outputs of productions that require one and
+        return them.
+        '''
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        return Lot.browse(cls.assign_output_lots(
+                productions, settings=settings, profiler=profiler))
+
+    @classmethod
+    def assign_output_lots(cls, productions, settings=None, profiler=None,
+            batch_size=None, skip_locked=False, filtered=False):
+        '''
+        Create and assign the lots of all the outputs of productions that
+        require one and return the ids of the created lots.
+        The outputs are generated and flushed by batches of batch_size
+        productions (the "batch_size" option of the "production_output_lot"
+        configuration section by default) so the memory does not grow with the
+        number of productions.
+        The outputs locked by another transaction are skipped if skip_locked
+        is set otherwise the call fails without waiting (see _lock_outputs).
+        filtered must be set when the productions are already reduced to those
+        with outputs requiring a lot (see filter_output_lot_required).
+        '''
+        if not productions:
+            return []
+        if batch_size is None:
+            batch_size = config.getint(
+                'production_output_lot', 'batch_size', default=1000)
+        own_profiler = None
+        if profiler is None:
+            profiler = own_profiler = OutputLotProfiler.get(
+                'create_output_lots', len(productions))
+        if settings is None:
+            with phase(profiler, 'config'):
+                groups = cls._get_output_lot_groups(productions)
+        else:
+            groups = [(None, productions, settings)]
+
+        lot_ids = []
+        for company, company_productions, settings in groups:
+            if not settings.sequence:
+                raise UserError(gettext(
+                    'production_output_lot.missing_output_lot_creation_config'))
+            context = {'company': company} if company is not None else {}
+            with Transaction().set_context(**context):
+                for output_lots in cls._generate_output_lots(
+                        [p.id for p in company_productions], settings,
+                        profiler, batch_size, skip_locked=skip_locked,
+                        filtered=filtered):
+                    lot_ids.extend(
+                        cls._flush_output_lots(output_lots, profiler))
+        if own_profiler:
+            own_profiler.log()
+        return lot_ids
+
+    @classmethod
+    def preview_output_lots(cls, productions):
+        '''
+        Return the lots that would be created for the outputs of productions
+        without writing nor consuming any sequence number.
+        Each output is described by a dictionary with the keys: move, lot (the
+        id of the reused lot), number, drag_lot, expiration_date and
+        shelf_life_expiration_date.
+        The numbers are indicative as other transactions may draw them first.
+        '''
+        batch_size = config.getint(
+            'production_output_lot', 'batch_size', default=1000)
+        previews = []
+        for company, company_productions, settings in (
+                cls._get_output_lot_groups(productions)):
+            if not settings.sequence:
+                raise UserError(gettext(
+                    'production_output_lot.missing_output_lot_creation_config'))
+            with Transaction().set_context(company=company):
+                previews.extend(cls._preview_output_lots(
+                        company_productions, settings, batch_size))
+        return previews
+
+    @classmethod
+    def _preview_output_lots(cls, productions, settings, batch_size):
+        previews = []
+        for output_lots in cls._generate_output_lots(
+                [p.id for p in productions], settings, None, batch_size,
+                preview=True):
+            for plan in output_lots:
+                previews.append({
+                        'move': plan.move,
+                        'lot': plan.lot_id,
+                        'number': plan.number,
+                        'drag_lot': plan.drag_lot,
+                        'expiration_date': plan.expiration_date,
+                        'shelf_life_expiration_date': (
+                            plan.shelf_life_expiration_date),
+                        })
+        return previews
+
+    @classmethod
+    def _generate_output_lots(cls, production_ids, settings, profiler,
+            batch_size, skip_locked=False, filtered=False, preview=False):
+        '''
+        Yield for each slice of batch_size productions the list of the
+        OutputLotPlan of their outputs that require a lot. The list must be
+        flushed before the next one is generated.
+        With preview, nothing is locked and the numbers are previewed instead
+        of drawn. With filtered, the productions are not filtered again.
+        '''
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+
+        # The plans of the new lots to reuse are kept between slices
+        previous_lots = {}
+        product_defaults = {}
+        previewed = defaultdict(int)
+        if not filtered:
+            with phase(profiler, 'filter'):
+                production_ids = cls.filter_output_lot_required(
+                    production_ids)
+        for sub_ids in grouped_slice(production_ids, batch_size):
+            productions = cls.browse(sub_ids)
+            with phase(profiler, 'drag_lot'):
+                drag_lots, expiration_dates = cls._prefetch_output_lots(
+                    productions)
+
+            with phase(profiler, 'outputs'):
+                production2outputs = defaultdict(list)
+                for output in Move.search([
+                            ('production_output', 'in',
+                                [p.id for p in productions]),
+                            ('lot', '=', None),
+                            ('state', 'in', _OUTPUT_LOT_STATES),
+                            ], order=[('id', 'ASC')]):
+                    production2outputs[output.production_output.id].append(
+                        output)
+
+                lot_required = Move.filter_lot_required(
+                    [o for p in productions
+                        for o in production2outputs[p.id]])
+                to_create = []
+                for production in productions:
+                    drag_lot = drag_lots.get(production.id)
+                    for output in production2outputs[production.id]:
+                        if output in lot_required:
+                            to_create.append((output, drag_lot))
+
+            if not preview:
+                with phase(profiler, 'lock'):
+                    locked = set(cls._lock_outputs(
+                            [o for o, _ in to_create],
+                            skip_locked=skip_locked))
+                    to_create = [
+                        (o, d) for o, d in to_create if o.id in locked]
+
+            # Draw the numbers of each sequence at once instead of one by one
+            # and always in the same order to prevent deadlocks
+            with phase(profiler, 'sequence'):
+                sequence2outputs = defaultdict(list)
+                for output, drag_lot in to_create:
+                    if not drag_lot:
+                        sequence2outputs[output._get_output_lot_sequence(
+                                settings=settings)].append(output)
+                numbers = {}
+                for sequence, sequence_outputs in sorted(
+                        sequence2outputs.items(),
+                        key=lambda i: (i[0].__name__, i[0].id)):
+                    count = len(sequence_outputs)
+                    if preview:
+                        sequence_numbers = Move.preview_output_lot_numbers(
+                            sequence, count, offset=previewed[sequence])
+                        previewed[sequence] += count
+                    else:
+                        sequence_numbers = Move.reserve_output_lot_numbers(
+                            sequence, count)
+                    numbers.update(zip(sequence_outputs, sequence_numbers))
+
+            reusable_lots = {}
+            if settings.reuse_drag_lot:
+                with phase(profiler, 'reuse'):
+                    keys = {(o.product.id, d.number)
+                        for o, d in to_create if d}
+                    reusable_lots = {k: previous_lots[k]
+                        for k in keys if k in previous_lots}
+                    reusable_lots.update(cls._get_reusable_output_lots(
+                            keys - reusable_lots.keys()))
+
+            plans = []
+            with phase(profiler, 'lot_build'):
+                for output, drag_lot in to_create:
+                    key = ((output.product.id, drag_lot.number)
+                        if drag_lot else None)
+                    plan = OutputLotPlan(output.id, output.product.id,
+                        drag_lot.number if drag_lot else numbers[output],
+                        drag_lot=drag_lot.id if drag_lot else None)
+                    plans.append(plan)
+                    if key in reusable_lots:
+                        reused = reusable_lots[key]
+                        if isinstance(reused, OutputLotPlan):
+                            plan.source = reused
+                        else:
+                            plan.lot = reused.id
+                        if hasattr(Lot, 'expiration_date'):
+                            plan.expiration_date = reused.expiration_date
+                            plan.shelf_life_expiration_date = (
+                                reused.shelf_life_expiration_date)
+                        continue
+                    if drag_lot and hasattr(Lot, 'expiration_date'):
+                        dates = {
+                            'expiration_date': drag_lot.expiration_date,
+                            'shelf_life_expiration_date': (
+                                drag_lot.shelf_life_expiration_date),
+                            }
+                    else:
+                        dates = output._get_production_output_lot_dates(
+                            expiration_dates.get(
+                                output.production_output.id),
+                            product_defaults=product_defaults)
+                    for name, value in dates.items():
+                        setattr(plan, name, value)
+                    if key and settings.reuse_drag_lot:
+                        reusable_lots[key] = plan
+            if plans:
+                yield plans
+            if settings.reuse_drag_lot:
+                previous_lots.update(reusable_lots)
+
+    @classmethod
+    def _lock_outputs(cls, outputs, skip_locked=False):
+        '''
+        Lock the outputs by increasing id without waiting and return the ids
+        of the locked ones.
+        If skip_locked is set, the outputs locked by another transaction are
+        skipped otherwise a DatabaseOperationalError is raised. It is up to
+        the caller to retry: the RPC dispatcher retries the request,
+        process_by_chunks reports the productions as failed so they can be
+        resumed and the queue retries the task.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        transaction = Transaction()
+        database = transaction.database
+        ids = sorted(o.id for o in outputs)
+        if not ids or not database.has_select_for():
+            return ids
+
+        move = Move.__table__()
+        cursor = transaction.connection.cursor()
+        if skip_locked:
+            for_ = database.get_select_for_skip_locked()('UPDATE')
+        else:
+            for_ = For('UPDATE', nowait=True)
+        locked = []
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*move.select(move.id,
+                    where=reduce_ids(move.id, sub_ids),
+                    order_by=[move.id.asc],
+                    for_=for_))
+            locked.extend(i for i, in cursor)
+        return locked
+
+    @classmethod
+    def _flush_output_lots(cls, plans, profiler=None):
+        '''
+        Create the new lots of the plans, link them to their outputs and
+        return the ids of the created lots.
+        '''
+        pool = Pool()
+        Genealogy = pool.get('stock.lot.genealogy')
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+
+        to_create = [p for p in plans if p.lot is None and p.source is None]
+        if to_create:
+            with phase(profiler, 'lot_save'):
+                outputs = Move.browse([p.move for p in to_create])
+                lots = Lot.create([o.get_production_output_lot_values(p)
+                        for o, p in zip(outputs, to_create)])
+            for plan, lot in zip(to_create, lots):
+                plan.lot = lot.id
+        with phase(profiler, 'move_save'):
+            lot2moves = defaultdict(list)
+            for plan in plans:
+                lot2moves[plan.lot_id].append(plan.move)
+            to_write = []
+            for lot_id, move_ids in lot2moves.items():
+                to_write.extend((Move.browse(move_ids), {'lot': lot_id}))
+            # The genealogy is populated once for all the lots below
+            with Transaction().set_context(_skip_lot_genealogy=True):
+                Move.write(*to_write)
+        with phase(profiler, 'genealogy'):
+            Genealogy.populate(list({o.production_output.id
+                        for o in Move.browse([p.move for p in plans])}))
+        return [p.lot for p in to_create]
+
+    @classmethod
+    def _get_reusable_output_lots(cls, keys):
+        'Return the existing lots indexed by the (product id, number) keys'
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        keys = set(keys)
+        lots = {}
+        for sub_keys in grouped_slice(sorted(keys)):
+            sub_keys = list(sub_keys)
+            for lot in Lot.search([
+                        ('product', 'in', list({p for p, _ in sub_keys})),
+                        ('number', 'in', list({n for _, n in sub_keys})),
+                        ], order=[('id', 'ASC')]):
+                key = (lot.product.id, lot.number)
+                if key in keys:
+                    lots.setdefault(key, lot)
+        return lots
+
+    @classmethod
+    def _prefetch_output_lots(cls, productions):
+        '''
+        Return the drag lot and the minimum expiration date of the input lots
+        of each production. The inputs, their lots and the BOM use lot flags
+        are loaded with a few bulk reads and the drag lot products of the BOMs
+        are cached.
+        '''
+        pool = Pool()
+        BOMInput = pool.get('production.bom.input')
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+
+        bom2product = BOMInput.get_drag_lot_products(
+            {p.bom.id for p in productions if p.bom})
+
+        production2inputs = defaultdict(list)
+        for sub_ids in grouped_slice([p.id for p in productions]):
+            for move in Move.search([
+                        ('production_input', 'in', list(sub_ids)),
+                        ('lot', '!=', None),
+                        ], order=[('id', 'ASC')]):
+                production2inputs[move.production_input.id].append(move)
+
+        drag_lots, expiration_dates = {}, {}
+        for production in productions:
+            inputs = production2inputs[production.id]
+            product_id = (bom2product.get(production.bom.id)
+                if production.bom else None)
+            if product_id is not None:
+                lots = [i.lot for i in inputs if i.product.id == product_id]
+                if len(lots) != 1:
                     raise UserError(gettext(
                         'production_output_lot.more_than_one_input_lots'))
-                drag_lot = inputs[0].lot
+                drag_lots[production.id] = lots[0]
+            if hasattr(Lot, 'expiration_date'):
+                expiration_dates[production.id] = min(
+                    (i.lot.expiration_date for i in inputs
+                        if i.lot.expiration_date), default=None)
+        return drag_lots, expiration_dates
+
+
+class CreateMissingOutputLotsStart(ModelView):
+    __name__ = 'production.create_missing_output_lots.start'
 
-        for output in self.outputs:
-            if output.lot:
-                continue
-            if output.product.lot_is_required(output.from_location, output.to_location):
-                lot = output.get_production_output_lot()
-                if lot:
-                    if drag_lot:
-                        lot.number = drag_lot.number
-                        lot.expiration_date = (drag_lot.expiration_date if
-                            drag_lot.expiration_date else None)
-                        lot.shelf_life_expiration_date = (
-                            drag_lot.shelf_life_expiration_date if
-                            drag_lot.shelf_life_expiration_date else None)
-                    lot.save()
-                    output.lot = lot
-                    output.save()
-                    created_lots.append(lot)
-        return created_lots
+
+class CreateMissingOutputLotsDone(ModelView):
+    __name__ = 'production.create_missing_output_lots.done'
+    lots = fields.Integer('Created Lots', readonly=True)
+
+
+class CreateMissingOutputLots(Wizard):
+    __name__ = 'production.create_missing_output_lots'
+    start = StateView('production.create_missing_output_lots.start',
+        'production_output_lot.create_missing_output_lots_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Create', 'create_', 'tryton-ok', default=True),
+            ])
+    create_ = StateTransition()
+    done = StateView('production.create_missing_output_lots.done',
+        'production_output_lot.create_missing_output_lots_done_view_form', [
+            Button('OK', 'end', 'tryton-ok', default=True),
+            ])
+
+    def transition_create_(self):
+        pool = Pool()
+        Production = pool.get('production')
+        self.done.lots = Production.create_missing_output_lots()
+        return 'done'
+
+    def default_done(self, fields):
+        return {
+            'lots': self.done.lots,
+            }
 
 
 class StockMove(metaclass=PoolMeta):
     __name__ = 'stock.move'
 
-    def get_production_output_lot(self):
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                # Input lots of the productions
+                Index(t,
+                    (t.production_input, Index.Range()),
+                    (t.product, Index.Range()),
+                    (t.lot, Index.Range()),
+                    where=(t.production_input != Null) & (t.lot != Null)),
+                # Outputs waiting for a lot
+                Index(t,
+                    (t.production_output, Index.Range()),
+                    where=(t.production_output != Null) & (t.lot == Null)),
+                })
+
+    @classmethod
+    def on_write(cls, moves, values):
+        pool = Pool()
+        Genealogy = pool.get('stock.lot.genealogy')
+        callback = super().on_write(moves, values)
+        if Transaction().context.get('_skip_lot_genealogy'):
+            return callback
+        if (values.keys() & {'lot', 'production_input', 'production_output'}
+                or ('state' in values
+                    and (values['state'] == 'cancelled'
+                        or any(m.state == 'cancelled' for m in moves)))):
+            production_ids = cls._get_lot_genealogy_productions(moves)
+            production_ids.update(filter(None, [
+                        values.get('production_input'),
+                        values.get('production_output')]))
+            if production_ids:
+                callback.append(
+                    lambda: Genealogy.populate(sorted(production_ids)))
+        return callback
+
+    @classmethod
+    def on_delete(cls, moves):
+        pool = Pool()
+        Genealogy = pool.get('stock.lot.genealogy')
+        callback = super().on_delete(moves)
+        production_ids = cls._get_lot_genealogy_productions(moves)
+        if production_ids:
+            callback.append(
+                lambda: Genealogy.populate(sorted(production_ids)))
+        return callback
+
+    @classmethod
+    def _get_lot_genealogy_productions(cls, moves):
+        'Return the ids of the productions whose lot genealogy the moves make'
+        return {p.id for m in moves
+            for p in [m.production_input, m.production_output] if p}
+
+    def get_production_output_lot(self, number=None,
+            input_expiration_date=_MISSING, product_defaults=None):
+        '''
+        Return a new lot for the output.
+        product_defaults is a dictionary used to compute the default dates of
+        each product only once.
+        '''
         pool = Pool()
         Lot = pool.get('stock.lot')
 
         if not self.production_output:
             return
 
-        number = self._get_output_lot_sequence().get()
-        lot = Lot(product=self.product, number=number)
+        if number is None:
+            number = self._get_output_lot_sequence().get()
+        plan = OutputLotPlan(self.id, self.product.id, number)
+
+        if hasattr(Lot, 'expiration_date') and self.product.expiration_time:
+            if input_expiration_date is _MISSING:
+                input_expiration_date = min(
+                    (i.lot.expiration_date
+                        for i in self.production_output.inputs
+                        if i.lot and i.lot.expiration_date),
+                    default=None)
+            for name, value in self._get_production_output_lot_dates(
+                    input_expiration_date,
+                    product_defaults=product_defaults).items():
+                setattr(plan, name, value)
+        return Lot(**self.get_production_output_lot_values(plan))
+
+    def get_production_output_lot_values(self, plan):
+        '''
+        Return the values to create the new lot of the OutputLotPlan of the
+        output.
+        '''
+        return plan.lot_values()
 
-        if hasattr(Lot, 'expiration_date'):
-            if self.product.expiration_time:
-                input_expiry_dates = [i.lot.expiration_date
-                    for i in self.production_output.inputs
-                    if i.lot and i.lot.expiration_date]
-                if input_expiry_dates:
-                    lot.expiration_date = min(input_expiry_dates)
-                else:
-                    lot.on_change_product()
-        return lot
+    def _get_production_output_lot_dates(self, input_expiration_date,
+            product_defaults=None):
+        '''
+        Return the expiration dates of the output lot from the minimum
+        expiration date of the inputs or from the product.
+        '''
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+
+        if not hasattr(Lot, 'expiration_date') or not (
+                self.product.expiration_time):
+            return {}
+        if input_expiration_date:
+            return {'expiration_date': input_expiration_date}
+        if product_defaults is not None and (
+                self.product.id in product_defaults):
+            return product_defaults[self.product.id]
+        lot = Lot(product=self.product)
+        lot.on_change_product()
+        dates = {f: getattr(lot, f, None)
+            for f in ['expiration_date', 'shelf_life_expiration_date']}
+        if product_defaults is not None:
+            product_defaults[self.product.id] = dates
+        return dates
+
+    @classmethod
+    def filter_lot_required(cls, moves):
+        '''
+        Return the set of moves whose product requires a lot.
+        The result is computed once per template and location types.
+        '''
+        required = {}
+        result = set()
+        for move in moves:
+            key = (move.product.template.id, move.from_location.type,
+                move.to_location.type)
+            if key not in required:
+                required[key] = move.product.lot_is_required(
+                    move.from_location, move.to_location)
+            if required[key]:
+                result.add(move)
+        return result
 
-    def _get_output_lot_sequence(self):
+    @classmethod
+    def reserve_output_lot_numbers(cls, sequence, count):
+        '''
+        Return count numbers of the sequence drawn in a single update or taken
+        from the number pool when it is enabled.
+        '''
+        if count <= 0:
+            return []
+        if number_pool.enabled(sequence):
+            return number_pool.take(sequence, count)
+        return list(sequence.get_many(n=count))
+
+    @classmethod
+    def preview_output_lot_numbers(cls, sequence, count, offset=0):
+        '''
+        Return the count numbers that would be drawn from the sequence after
+        offset numbers without consuming them.
+        '''
+        if sequence.type != 'incremental':
+            return [sequence.preview] * count
+        prefix = sequence._process(sequence.prefix)
+        suffix = sequence._process(sequence.suffix)
+        start = (sequence.number_next or 0) + (
+            offset * sequence.number_increment)
+        return [f'{prefix}{n:0>{sequence.padding or 0}d}{suffix}'
+            for n in range(start,
+                start + count * sequence.number_increment,
+                sequence.number_increment)]
+
+    def _get_output_lot_sequence(self, settings=None):
         pool = Pool()
         Config = pool.get('production.configuration')
-        config = Config(1)
         if hasattr(self.product, 'lot_sequence') and self.product.lot_sequence:
             return self.product.lot_sequence
-        elif not config.output_lot_sequence:
+        if settings is None:
+            settings = Config.get_output_lot_settings()
+        if not settings.sequence:
             raise UserError(gettext('production_output_lot.no_sequence'))
-        return config.output_lot_sequence
+        return settings.sequence
+
+
+class Lot(metaclass=PoolMeta):
+    __name__ = 'stock.lot'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.product, Index.Equality()),
+                (t.number, Index.Equality(cardinality='high'))))
+
+
+class LotGenealogy(ModelSQL):
+    'Lot Genealogy'
+    __name__ = 'stock.lot.genealogy'
+
+    input_lot = fields.Many2One('stock.lot', "Input Lot", required=True,
+        ondelete='CASCADE')
+    output_lot = fields.Many2One('stock.lot', "Output Lot", required=True,
+        ondelete='CASCADE')
+    production = fields.Many2One('production', "Production", required=True,
+        ondelete='CASCADE')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('input_output_production_unique',
+                Unique(t, t.input_lot, t.output_lot, t.production),
+                'production_output_lot.genealogy_unique'),
+            ]
+        cls._sql_indexes.add(
+            Index(t,
+                (t.output_lot, Index.Range()),
+                (t.input_lot, Index.Range())))
+        cls.__rpc__.update({
+                'trace': RPC(readonly=True),
+                })
+
+    @classmethod
+    def __register__(cls, module):
+        exist = backend.TableHandler.table_exist(cls._table)
+        super().__register__(module)
+        # Backfill the genealogy of the existing productions
+        if not exist:
+            cls.populate()
+
+    @classmethod
+    def populate(cls, production_ids=None):
+        '''
+        Link the lots of the inputs to the lots of the outputs of the
+        productions of production_ids or all of them.
+        The links which no longer match the lots of the moves (because a lot
+        has been changed or a move cancelled) are deleted and the missing ones
+        are inserted in bulk so it can be called again to catch up with the
+        lots set manually.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        table = cls.__table__()
+        existing = cls.__table__()
+        input_ = Move.__table__()
+        output = Move.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        def delete(where):
+            where &= ~Exists(output.join(input_,
+                    condition=input_.production_input
+                    == output.production_output
+                    ).select(output.id,
+                    where=(output.production_output == existing.production)
+                    & (input_.lot == existing.input_lot)
+                    & (output.lot == existing.output_lot)
+                    & (input_.state != 'cancelled')
+                    & (output.state != 'cancelled')))
+            cursor.execute(*table.delete(
+                    where=table.id.in_(existing.select(existing.id,
+                            where=where))))
+
+        def insert(where):
+            where &= ((input_.lot != Null)
+                & (output.lot != Null)
+                & (input_.state != 'cancelled')
+                & (output.state != 'cancelled')
+                & ~Exists(existing.select(existing.id,
+                        where=(existing.input_lot == input_.lot)
+                        & (existing.output_lot == output.lot)
+                        & (existing.production == output.production_output))))
+            query = output.join(input_,
+                condition=input_.production_input == output.production_output
+                ).select(
+                    input_.lot, output.lot, output.production_output,
+                    Literal(transaction.user), CurrentTimestamp(),
+                    where=where,
+                    group_by=[input_.lot, output.lot, output.production_output])
+            cursor.execute(*table.insert([
+                        table.input_lot, table.output_lot, table.production,
+                        table.create_uid, table.create_date,
+                        ], query))
+
+        if production_ids is None:
+            delete(Literal(True))
+            insert(output.production_output != Null)
+        else:
+            for sub_ids in grouped_slice(production_ids):
+                sub_ids = list(sub_ids)
+                delete(reduce_ids(existing.production, sub_ids))
+                insert(reduce_ids(output.production_output, sub_ids))
+
+    @classmethod
+    def trace(cls, lot_ids, backward=False, max_depth=None):
+        '''
+        Return the ids of the lots produced from the lots of lot_ids at any
+        level or, with backward, the ids of the lots used to produce them.
+        The levels can be limited to max_depth.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if backward:
+            source, target = table.output_lot, table.input_lot
+        else:
+            source, target = table.input_lot, table.output_lot
+        # Without depth, the union of the lots stops on cycles
+        if max_depth is None:
+            tree = With('lot', recursive=True)
+            tree.query = table.select(target,
+                where=reduce_ids(source, lot_ids))
+            tree.query |= table.join(tree,
+                condition=source == tree.lot).select(target)
+        else:
+            tree = With('lot', 'depth', recursive=True)
+            tree.query = table.select(target, Literal(1),
+                where=reduce_ids(source, lot_ids))
+            tree.query |= table.join(tree,
+                condition=source == tree.lot).select(
+                    target, tree.depth + 1, where=tree.depth < max_depth)
+        cursor.execute(*tree.select(tree.lot,
+                group_by=[tree.lot], order_by=[tree.lot.asc], with_=[tree]))
+        return [l for l, in cursor]
@@ -0,0 +1,324 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Benchmark of the output lot creation of productions.
+
+It generates synthetic BOMs and productions and reports, for each output lot
+creation mode and size, the wall time, the number of SQL queries and the peak
+memory of the run and do transitions::
+
+    python -m trytond.modules.production_output_lot.tests.benchmark \\
+        --sizes 10 100 1000 --outputs 2 --inputs 3
+
+An in-memory SQLite database is used unless the TRYTOND_DATABASE_URI and
+DB_NAME environment variables point to another database. With
+--max-queries the exit status is non-zero when a phase runs more queries per
+production than the limit, so it can be used as a regression guard.
+
+With --workers, the productions are instead run and done by parallel
+transactions sharing the same lot sequence, and the throughput is reported
+for each number of workers::
+
+    DB_NAME=bench TRYTOND_DATABASE_URI=postgresql:// \\
+    python -m trytond.modules.production_output_lot.tests.benchmark \\
+        --sizes 1000 --workers 1 2 4 8
+
+It requires a database that can be shared between connections, so not an
+in-memory SQLite database.
+'''
+import argparse
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from decimal import Decimal
+
+from trytond import backend
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.production_output_lot.instrumentation import (
+    QueryCounter)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import (
+    DB_NAME, activate_module, with_transaction)
+from trytond.transaction import Transaction, TransactionError
+
+MODES = ['running', 'running_deferred', 'done']
+
+
+def setup(company, size, outputs, inputs, drag_lot, sled):
+    'Create a BOM and size productions ready to be run'
+    pool = Pool()
+    BOM = pool.get('production.bom')
+    Location = pool.get('stock.location')
+    Lot = pool.get('stock.lot')
+    Product = pool.get('product.product')
+    Production = pool.get('production')
+    Sequence = pool.get('ir.sequence')
+    SequenceType = pool.get('ir.sequence.type')
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+    ModelData = pool.get('ir.model.data')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    sequence_type = SequenceType(
+        ModelData.get_id('stock_lot', 'sequence_type_stock_lot'))
+    sequence, = Sequence.create([{
+                'sequence_type': sequence_type.id,
+                'name': 'Output Lot',
+                }])
+
+    input_values = [{
+            'name': 'Input %s' % i,
+            'type': 'goods',
+            'consumable': True,
+            'default_uom': unit.id,
+            } for i in range(inputs)]
+    output_values = [{
+            'name': 'Output %s' % i,
+            'type': 'goods',
+            'producible': True,
+            'list_price': Decimal(10),
+            'default_uom': unit.id,
+            'lot_required': ['storage'],
+            } for i in range(outputs)]
+    if sled:
+        for values in output_values:
+            values['expiration_state'] = 'optional'
+            values['expiration_time'] = 30
+    templates = Template.create(input_values + output_values)
+    products = Product.create([{'template': t.id} for t in templates])
+    input_products, output_products = products[:inputs], products[inputs:]
+
+    bom, = BOM.create([{
+                'name': 'Benchmark',
+                'inputs': [('create', [{
+                                'product': p.id,
+                                'quantity': 1,
+                                'unit': unit.id,
+                                'use_lot': drag_lot and i == 0,
+                                } for i, p in enumerate(input_products)])],
+                'outputs': [('create', [{
+                                'product': p.id,
+                                'quantity': 1,
+                                'unit': unit.id,
+                                } for p in output_products])],
+                }])
+
+    lots = [None] * size
+    if drag_lot and input_products:
+        lots = Lot.create([{
+                    'number': 'IN%s' % i,
+                    'product': input_products[0].id,
+                    } for i in range(size)])
+
+    warehouse = Location(Production.default_warehouse())
+    storage = warehouse.storage_location
+    production_location = warehouse.production_location
+    productions = Production.create([{
+                'product': output_products[0].id,
+                'bom': bom.id,
+                'unit': unit.id,
+                'quantity': 1,
+                'inputs': [('create', [{
+                                'product': p.id,
+                                'lot': lot.id if lot and i == 0 else None,
+                                'unit': unit.id,
+                                'quantity': 1,
+                                'from_location': storage.id,
+                                'to_location': production_location.id,
+                                } for i, p in enumerate(input_products)])],
+                'outputs': [('create', [{
+                                'product': p.id,
+                                'unit': unit.id,
+                                'quantity': 1,
+                                'from_location': production_location.id,
+                                'to_location': storage.id,
+                                'unit_price': Decimal(0),
+                                'currency': company.currency.id,
+                                } for p in output_products])],
+                } for lot in lots])
+    Production.wait(productions)
+    Production.assign(productions)
+    return sequence, productions
+
+
+def measure(func, *args, memory=True):
+    'Return the wall time, the queries and the peak memory of calling func'
+    peak = 0
+    if memory:
+        tracemalloc.start()
+    try:
+        with QueryCounter() as counter:
+            start = time.perf_counter()
+            func(*args)
+            duration = time.perf_counter() - start
+        if memory:
+            _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if memory:
+            tracemalloc.stop()
+    return duration, counter.count, peak
+
+
+@with_transaction()
+def benchmark(mode, size, outputs, inputs, drag_lot, sled, memory, profile):
+    pool = Pool()
+    Configuration = pool.get('production.configuration')
+    Production = pool.get('production')
+
+    results = []
+    company = create_company()
+    with set_company(company), \
+            Transaction().set_context(output_lot_profile=profile):
+        sequence, productions = setup(
+            company, size, outputs, inputs, drag_lot, sled)
+        config = Configuration(1)
+        config.output_lot_creation = mode
+        config.output_lot_sequence = sequence
+        config.save()
+
+        ids = [p.id for p in productions]
+        results.append(('run',) + measure(
+                Production.run, Production.browse(ids), memory=memory))
+        if mode == 'running_deferred':
+            results.append(('task',) + measure(
+                    Production.create_output_lots_deferred,
+                    Production.browse(ids), memory=memory))
+        results.append(('do',) + measure(
+                Production.do, Production.browse(ids), memory=memory))
+    return results
+
+
+def commit(func, *args, context=None, retries=None):
+    'Call func in a transaction committed and retried until it succeeds'
+    extras = {}
+    while True:
+        with Transaction().start(DB_NAME, 1, context=context,
+                **extras) as transaction:
+            try:
+                result = func(*args)
+                transaction.commit()
+            except TransactionError as e:
+                transaction.rollback()
+                e.fix(extras)
+            except backend.DatabaseOperationalError:
+                transaction.rollback()
+            else:
+                return result
+        if retries is not None:
+            retries.append(args)
+
+
+def stress(mode, size, workers, outputs, inputs, drag_lot, sled):
+    '''
+    Run and do size productions with parallel transactions and return the
+    duration and the number of retried transactions
+    '''
+    def prepare():
+        pool = Pool()
+        Configuration = pool.get('production.configuration')
+        company = create_company()
+        with set_company(company):
+            sequence, productions = setup(
+                company, size, outputs, inputs, drag_lot, sled)
+            config = Configuration(1)
+            config.output_lot_creation = mode
+            config.output_lot_sequence = sequence
+            config.save()
+        return company.id, [p.id for p in productions]
+
+    def close(ids):
+        Production = Pool().get('production')
+        Production.run(Production.browse(ids))
+        if mode == 'running_deferred':
+            Production.create_output_lots_deferred(Production.browse(ids))
+        Production.do(Production.browse(ids))
+
+    company_id, ids = commit(prepare)
+    retries = []
+    # Interleave the productions so the workers compete for the sequence
+    threads = [threading.Thread(target=commit, args=(close, ids[i::workers]),
+            kwargs={'context': {'company': company_id}, 'retries': retries})
+        for i in range(workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, len(retries)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the output lot creation of productions")
+    parser.add_argument('--sizes', type=int, nargs='+',
+        default=[10, 100, 1000], help="number of productions")
+    parser.add_argument('--outputs', type=int, default=1,
+        help="number of outputs per production")
+    parser.add_argument('--inputs', type=int, default=1,
+        help="number of inputs per production")
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES,
+        help="output lot creation modes")
+    parser.add_argument('--drag-lot', action='store_true',
+        help="drag the lot of the first input")
+    parser.add_argument('--sled', action='store_true',
+        help="activate stock_lot_sled")
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+        help="do not trace the memory as it slows down the execution")
+    parser.add_argument('--profile', action='store_true',
+        help="log the time and queries of each lot creation phase")
+    parser.add_argument('--max-queries', type=float,
+        help="fail when a phase runs more queries per production")
+    parser.add_argument('--workers', type=int, nargs='+',
+        help="run the productions with parallel transactions")
+    options = parser.parse_args(args)
+    if options.workers and DB_NAME == ':memory:':
+        parser.error("--workers requires a database not in memory")
+
+    if options.profile:
+        logging.basicConfig()
+        logging.getLogger(
+            'trytond.modules.production_output_lot.instrumentation'
+            ).setLevel(logging.INFO)
+
+    modules = ['production_output_lot']
+    if options.sled:
+        modules.append('stock_lot_sled')
+    activate_module(modules)
+
+    if options.workers:
+        print('%-17s %7s %7s %10s %10s %7s' % (
+                'mode', 'size', 'workers', 'time (s)', 'prod/s', 'retries'))
+        for mode in options.modes:
+            for size in options.sizes:
+                for workers in options.workers:
+                    duration, retries = stress(mode, size, workers,
+                        options.outputs, options.inputs, options.drag_lot,
+                        options.sled)
+                    print('%-17s %7d %7d %10.3f %10.1f %7d' % (
+                            mode, size, workers, duration, size / duration,
+                            retries))
+        return 0
+
+    failed = False
+    print('%-17s %7s %5s %10s %9s %10s %11s' % (
+            'mode', 'size', 'phase', 'time (s)', 'queries', 'query/prod',
+            'memory (kB)'))
+    for mode in options.modes:
+        for size in options.sizes:
+            for phase, duration, queries, peak in benchmark(mode, size,
+                    options.outputs, options.inputs, options.drag_lot,
+                    options.sled, options.memory, options.profile):
+                per_production = queries / size
+                print('%-17s %7d %5s %10.3f %9d %10.1f %11d' % (
+                        mode, size, phase, duration, queries, per_production,
+                        peak // 1024))
+                if (options.max_queries is not None
+                        and per_production > options.max_queries):
+                    failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,12 +2,127 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
+import datetime
+import xmlrpc.client
 from decimal import Decimal
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from sql import For
+
+from trytond import backend
 from trytond.exceptions import UserError
+from trytond.model.exceptions import ValidationError
 from trytond.pool import Pool
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
 
 from trytond.modules.company.tests import create_company, set_company, CompanyTestMixin
+from trytond.modules.production_output_lot.instrumentation import (
+    QueryCounter)
+from trytond.modules.production_output_lot.number_pool import LotNumberPool
+
+
+def create_output_lot_setup(company, creation='running', prefix=None,
+        **output_values):
+    '''
+    Create the lot sequence and the output lot configuration of the company,
+    an input product, an output product requiring a lot (updated with
+    output_values) and a BOM dragging the lot of the input to the output.
+    '''
+    pool = Pool()
+    BOM = pool.get('production.bom')
+    Location = pool.get('stock.location')
+    Product = pool.get('product.product')
+    Production = pool.get('production')
+    ProductConfig = pool.get('production.configuration')
+    Sequence = pool.get('ir.sequence')
+    SequenceType = pool.get('ir.sequence.type')
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+    ModelData = pool.get('ir.model.data')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    sequence_type = SequenceType(ModelData.get_id('stock_lot',
+            'sequence_type_stock_lot'))
+    lot_sequence, = Sequence.create([{
+                'sequence_type': sequence_type.id,
+                'name': 'Lot',
+                'prefix': prefix,
+                'company': company.id,
+                }])
+    config = ProductConfig(1)
+    config.output_lot_creation = creation
+    config.output_lot_sequence = lot_sequence
+    config.save()
+
+    input_template, output_template = Template.create([{
+                'name': 'Input',
+                'type': 'goods',
+                'default_uom': unit.id,
+                }, {
+                'name': 'Output',
+                'type': 'goods',
+                'producible': True,
+                'default_uom': unit.id,
+                'lot_required': ['storage'],
+                **output_values,
+                }])
+    input_product, output_product = Product.create([{
+                'template': t.id,
+                } for t in [input_template, output_template]])
+    bom, = BOM.create([{
+                'name': 'BOM',
+                'inputs': [('create', [{
+                                'product': input_product.id,
+                                'quantity': 1,
+                                'unit': unit.id,
+                                'use_lot': True,
+                                }])],
+                'outputs': [('create', [{
+                                'product': output_product.id,
+                                'quantity': 1,
+                                'unit': unit.id,
+                                }])],
+                }])
+    return SimpleNamespace(company=company, unit=unit,
+        lot_sequence=lot_sequence, config=config,
+        input_product=input_product, output_product=output_product, bom=bom,
+        warehouse=Location(Production.default_warehouse()))
+
+
+def create_productions(setup, inputs, bom=None, outputs=1):
+    '''
+    Create a production of the output product of setup for each list of input
+    lots of inputs with the number of outputs
+    '''
+    pool = Pool()
+    Production = pool.get('production')
+    storage_loc = setup.warehouse.storage_location
+    production_loc = setup.warehouse.production_location
+    return Production.create([{
+                'product': setup.output_product.id,
+                'bom': bom.id if bom else None,
+                'unit': setup.unit.id,
+                'quantity': 1,
+                'inputs': [('create', [{
+                                'product': setup.input_product.id,
+                                'lot': lot.id,
+                                'unit': setup.unit.id,
+                                'quantity': 1,
+                                'from_location': storage_loc.id,
+                                'to_location': production_loc.id,
+                                } for lot in lots])],
+                'outputs': [('create', [{
+                                'product': setup.output_product.id,
+                                'unit': setup.unit.id,
+                                'quantity': 1,
+                                'from_location': production_loc.id,
+                                'to_location': storage_loc.id,
+                                'unit_price': Decimal(0),
+                                'currency': setup.company.currency.id,
+                                }] * outputs)],
+                } for lots in inputs])
 
 
 class ProductionOutputLotTestCase(CompanyTestMixin, ModuleTestCase):
@@ -27,6 +142,7 @@ class ProductionOutputLotTestCase(CompanyTestMixin, ModuleTestCase):
         Template = pool.get('product.template')
         Uom = pool.get('product.uom')
         ModelData = pool.get('ir.model.data')
+        Queue = pool.get('ir.queue')
 
         # Create Company
         company = create_company()
@@ -131,7 +247,8 @@ class ProductionOutputLotTestCase(CompanyTestMixin, ModuleTestCase):
                         ],
                     }])
             productions = [production_wo_lot, production_w_lot]
-            production_w_lot2, = Production.copy([production_w_lot])
+            production_w_lot2, production_w_lot3, production_w_lot4 = (
+                Production.copy([production_w_lot] * 3))
 
             Production.wait(productions)
             Production.assign_try(productions)
@@ -147,12 +264,36 @@ class ProductionOutputLotTestCase(CompanyTestMixin, ModuleTestCase):
             config.output_lot_sequence = lot_sequence
             config.save()
 
-            Production.run(productions)
+            self.assertEqual(
+                Production.filter_output_lot_required(
+                    [p.id for p in productions]),
+                [production_w_lot.id])
+
+            # Preview does not consume numbers
+            preview, = Production.preview_output_lots(productions)
+            self.assertEqual(preview['move'], production_w_lot.outputs[0].id)
+            self.assertIsNone(preview['lot'])
+            self.assertIsNone(preview['drag_lot'])
+            self.assertEqual(
+                Production.preview_output_lots(productions), [preview])
+
+            # The productions are filtered once
+            with patch.object(Production, 'filter_output_lot_required',
+                    wraps=Production.filter_output_lot_required) as filter_:
+                Production.run(productions)
+            filter_.assert_called_once()
             self.assertTrue(all(i.state == 'done' for p in productions
                     for i in p.inputs))
             self.assertIsNone(production_wo_lot.outputs[0].lot)
             self.assertIsNotNone(production_w_lot.outputs[0].lot)
             created_lot = production_w_lot.outputs[0].lot
+            self.assertEqual(created_lot.number, preview['number'])
+            self.assertEqual(Production.preview_output_lots(productions), [])
+            self.assertEqual(
+                Production.filter_output_lot_required(
+                    [p.id for p in productions]), [])
+            self.assertEqual(
+                Production.create_output_lots_batch(productions), [])
 
             Production.do(productions)
             self.assertEqual([p.state for p in productions],
@@ -176,5 +317,688 @@ class ProductionOutputLotTestCase(CompanyTestMixin, ModuleTestCase):
             self.assertEqual(production_w_lot2.state, 'done')
             self.assertIsNotNone(production_w_lot2.outputs[0].lot)
 
+            # Create lot on 'running' state from the queue
+            config.output_lot_creation = 'running_deferred'
+            config.save()
+
+            productions = [production_w_lot3, production_w_lot4]
+            Production.wait(productions)
+            Production.assign_try(productions)
+
+            Production.run(productions)
+            self.assertIsNone(production_w_lot3.outputs[0].lot)
+            self.assertTrue(Queue.search([
+                        ('data.method', '=', 'create_output_lots_deferred'),
+                        ]))
+
+            Production.create_output_lots_deferred([production_w_lot3])
+            created_lot = production_w_lot3.outputs[0].lot
+            self.assertIsNotNone(created_lot)
+            self.assertIsNone(production_w_lot4.outputs[0].lot)
+            self.assertEqual(
+                Production._get_missing_output_lot_productions(),
+                [production_w_lot4.id])
+
+            Production.do(productions)
+            self.assertEqual(production_w_lot3.outputs[0].lot, created_lot)
+            self.assertIsNotNone(production_w_lot4.outputs[0].lot)
+
+    @with_transaction()
+    def test0020reserve_output_lot_numbers(self):
+        'Test reserve output lot numbers.'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Sequence = pool.get('ir.sequence')
+        SequenceType = pool.get('ir.sequence.type')
+        ModelData = pool.get('ir.model.data')
+
+        sequence_type = SequenceType(ModelData.get_id('stock_lot',
+                'sequence_type_stock_lot'))
+        lot_sequence, = Sequence.create([{
+                    'sequence_type': sequence_type.id,
+                    'name': 'Lot',
+                    }])
+
+        self.assertEqual(Move.reserve_output_lot_numbers(lot_sequence, 0), [])
+        self.assertEqual(Move.reserve_output_lot_numbers(lot_sequence, 3),
+            ['1', '2', '3'])
+        self.assertEqual(lot_sequence.get(), '4')
+
+    @with_transaction()
+    def test0030unique_use_lot_in_bom(self):
+        'Test only one input per BOM uses lot.'
+        pool = Pool()
+        BOM = pool.get('production.bom')
+        BOMInput = pool.get('production.bom.input')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template1, template2 = Template.create([{
+                    'name': 'Component %s' % i,
+                    'type': 'goods',
+                    'default_uom': unit.id,
+                    } for i in range(2)])
+        product1, product2 = Product.create([{
+                    'template': t.id,
+                    } for t in [template1, template2]])
+
+        bom1, bom2 = BOM.create([{
+                    'name': 'BOM %s' % i,
+                    'inputs': [('create', [{
+                                    'product': p.id,
+                                    'quantity': 1,
+                                    'unit': unit.id,
+                                    'use_lot': p == product1,
+                                    } for p in [product1, product2]])],
+                    } for i in range(2)])
+
+        # Inputs of different BOMs can use lot
+        BOMInput.write([i for i in bom1.inputs + bom2.inputs
+                if i.use_lot], {'use_lot': True})
+        self.assertEqual(BOMInput.get_drag_lot_products([bom1.id, bom2.id]),
+            {bom1.id: product1.id, bom2.id: product1.id})
+
+        # The cache is cleared by the modifications
+        BOMInput.write([i for i in bom2.inputs], {'use_lot': False})
+        self.assertEqual(BOMInput.get_drag_lot_products([bom1.id, bom2.id]),
+            {bom1.id: product1.id, bom2.id: None})
+
+        input1, = [i for i in bom1.inputs if i.use_lot]
+        input1.check_unique_use_lot_in_bom()
+        BOMInput.check_unique_use_lot_in_boms(bom1.inputs + bom2.inputs)
+
+        input2, = [i for i in bom1.inputs if not i.use_lot]
+        with self.assertRaises(ValidationError):
+            BOMInput.write([input2], {'use_lot': True})
+
+    @with_transaction()
+    def test0040drag_lot(self):
+        'Test output lot drags the number of the input lot.'
+        pool = Pool()
+        Genealogy = pool.get('stock.lot.genealogy')
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+        Production = pool.get('production')
+        ProductConfig = pool.get('production.configuration')
+
+        company = create_company()
+        with set_company(company):
+            setup = create_output_lot_setup(company)
+            config, output_product = setup.config, setup.output_product
+            input_lot, other_lot, new_lot = Lot.create([{
+                        'number': number,
+                        'product': setup.input_product.id,
+                        } for number in ['IN1', 'IN2', 'IN3']])
+
+            def create_production(lots):
+                production, = create_productions(setup, [lots], bom=setup.bom)
+                return production
+
+            production1 = create_production([input_lot])
+            production2 = create_production([input_lot])
+            self.assertEqual(
+                [(p['number'], p['drag_lot']) for p in
+                    Production.preview_output_lots([production1, production2])],
+                [('IN1', input_lot.id)] * 2)
+            plans, = Production._generate_output_lots(
+                [production1.id, production2.id],
+                ProductConfig.get_output_lot_settings(), None, 10,
+                preview=True)
+            self.assertEqual(
+                [(p.move, p.product, p.number, p.lot_id) for p in plans],
+                [(p.outputs[0].id, output_product.id, 'IN1', None)
+                    for p in [production1, production2]])
+            self.assertEqual(plans[0].lot_values(), {
+                    'product': output_product.id,
+                    'number': 'IN1',
+                    })
+            with Transaction().set_context(output_lot_profile=True), \
+                    self.assertLogs(
+                        'trytond.modules.production_output_lot.'
+                        'instrumentation') as logs:
+                lots = Production.create_output_lots_batch(
+                    [production1, production2])
+            profile, = [r.output_lot_profile for r in logs.records]
+            self.assertEqual(profile['count'], 2)
+            self.assertIn('lot_save', profile['phases'])
+            self.assertEqual([l.number for l in lots], ['IN1', 'IN1'])
+            output, = production1.outputs
+            self.assertEqual(output.lot.number, 'IN1')
+            # No number has been consumed
+            self.assertEqual(setup.lot_sequence.get(), '1')
+
+            # The genealogy of the lots is stored
+            self.assertEqual(
+                Genealogy.trace([input_lot.id]), sorted(l.id for l in lots))
+            self.assertEqual(
+                Genealogy.trace([lots[0].id], backward=True), [input_lot.id])
+            Genealogy.populate()
+            self.assertEqual(Genealogy.search([], count=True), 2)
+            Genealogy.create([{
+                        'input_lot': lots[0].id,
+                        'output_lot': other_lot.id,
+                        'production': production1.id,
+                        }])
+            self.assertIn(other_lot.id, Genealogy.trace([input_lot.id]))
+            self.assertNotIn(
+                other_lot.id, Genealogy.trace([input_lot.id], max_depth=1))
+            self.assertIn(input_lot.id,
+                Genealogy.trace([other_lot.id], backward=True))
+            Genealogy.delete(Genealogy.search([
+                        ('output_lot', '=', other_lot.id),
+                        ]))
+
+            # Reuse the existing output lot
+            config.output_lot_reuse_drag_lot = True
+            config.save()
+            production4 = create_production([input_lot])
+            production5 = create_production([other_lot])
+            lots = Production.create_output_lots_batch(
+                [production4, production5])
+            self.assertEqual([l.number for l in lots], ['IN2'])
+            output, = production4.outputs
+            self.assertEqual(output.lot, production1.outputs[0].lot)
+
+            # A new lot is reused by the next batches
+            production6 = create_production([new_lot])
+            production7 = create_production([new_lot])
+            self.assertEqual(
+                [(p['number'], p['lot']) for p in
+                    Production.preview_output_lots([production6, production7])],
+                [('IN3', None)] * 2)
+            lot_ids = Production.assign_output_lots(
+                [production6, production7], batch_size=1)
+            self.assertEqual(len(lot_ids), 1)
+            self.assertEqual(
+                [p.outputs[0].lot.id for p in [production6, production7]],
+                lot_ids * 2)
+
+            production3 = create_production([input_lot, other_lot])
+            with self.assertRaises(UserError):
+                production3.create_output_lots()
+
+            # All the offending productions are reported at once
+            production8 = create_production([])
+            Production.check_output_lot_inputs([production1, production2])
+            with self.assertRaises(UserError) as cm:
+                Production.check_output_lot_inputs(
+                    [production1, production3, production8])
+            self.assertIn(production3.rec_name, cm.exception.message)
+            self.assertIn(production8.rec_name, cm.exception.message)
+            self.assertNotIn(production1.rec_name, cm.exception.message)
+
+            # The genealogy follows the lots of the moves
+            output, = production6.outputs
+            changed_lot, = Lot.create([{
+                        'number': 'OUT',
+                        'product': output_product.id,
+                        }])
+            output.lot = changed_lot
+            output.save()
+            self.assertEqual(
+                Genealogy.trace([new_lot.id]),
+                [lot_ids[0], changed_lot.id])
+            Move.cancel(production7.inputs)
+            self.assertEqual(Genealogy.trace([new_lot.id]), [changed_lot.id])
+            Move.delete(production6.inputs)
+            self.assertEqual(Genealogy.trace([new_lot.id]), [])
+
+    @with_transaction()
+    def test0050number_pool(self):
+        'Test lot number pool hands out claimed blocks.'
+        pool = Pool()
+        Sequence = pool.get('ir.sequence')
+        SequenceType = pool.get('ir.sequence.type')
+        ModelData = pool.get('ir.model.data')
+
+        sequence_type = SequenceType(ModelData.get_id('stock_lot',
+                'sequence_type_stock_lot'))
+        lot_sequence, = Sequence.create([{
+                    'sequence_type': sequence_type.id,
+                    'name': 'Lot',
+                    }])
+
+        claims = []
+
+        class TestLotNumberPool(LotNumberPool):
+            # SQLite can not commit the claims and releases separately
+
+            def size(self):
+                return 3
+
+            def _claim(self, sequence, count):
+                claims.append(count)
+                return self._draw(Sequence(sequence.id), count)
+
+            def _release(self, database_name, sequence_id, block):
+                self._give_back(Sequence(sequence_id), block)
+
+        number_pool = TestLotNumberPool()
+        self.assertEqual(number_pool.take(lot_sequence, 2), ['1', '2'])
+        self.assertEqual(number_pool.take(lot_sequence, 2), ['3', '4'])
+        self.assertEqual(number_pool.take(lot_sequence, 6), ['5', '6', '7',
+                '8', '9', '10'])
+        self.assertEqual(claims, [3, 3, 4])
+        block, = number_pool._blocks.values()
+        self.assertEqual(block.end, 11)
+
+        # The unused numbers are given back to the sequence
+        self.assertEqual(number_pool.take(lot_sequence, 1), ['11'])
+        self.assertEqual(list(block.numbers), ['12', '13'])
+        number_pool.release()
+        self.assertFalse(number_pool._blocks)
+        self.assertEqual(lot_sequence.get(), '12')
+
+        # Unless other numbers have been drawn after them
+        self.assertEqual(number_pool.take(lot_sequence, 1), ['13'])
+        self.assertEqual(lot_sequence.get(), '16')
+        number_pool.release()
+        self.assertEqual(lot_sequence.get(), '17')
+
+        # Nor when another worker draws a number during the claim
+        get_many = Sequence.get_many
+        interleaved = []
+
+        def interleave(self, n=1, _lock=False):
+            numbers = list(get_many(self, n=n, _lock=_lock))
+            interleaved.extend(get_many(Sequence(self.id)))
+            return iter(numbers)
+
+        with patch.object(Sequence, 'get_many', interleave):
+            self.assertEqual(number_pool.take(lot_sequence, 1), ['18'])
+        self.assertEqual(interleaved, ['21'])
+        block, = number_pool._blocks.values()
+        self.assertEqual(block.end, 21)
+        number_pool.release()
+        self.assertEqual(lot_sequence.get(), '22')
+
+        # The SQL sequences are never rewound
+        transaction = Transaction()
+        with patch.object(transaction.database, 'has_sequence',
+                return_value=True):
+            self.assertEqual(number_pool.take(lot_sequence, 1), ['23'])
+        block, = number_pool._blocks.values()
+        self.assertIsNone(block.end)
+        number_pool.release()
+        self.assertEqual(lot_sequence.get(), '26')
+
+    @with_transaction()
+    def test0060indexes(self):
+        'Test output lot indexes are created.'
+        pool = Pool()
+        BOMInput = pool.get('production.bom.input')
+        Move = pool.get('stock.move')
+
+        for Model, columns in [
+                (BOMInput, ['bom']),
+                (Move, ['production_input', 'product', 'lot']),
+                (Move, ['production_output']),
+                ]:
+            table_h = Model.__table_handler__()
+            index, = [i for i in Model._sql_indexes
+                if 'lot"' in str(i.options.get('where'))
+                and [str(c) for c, _ in i.expressions] == [
+                    '"%s"' % c for c in columns]]
+            name, _, _ = table_h.index_translator_for(index).definition(
+                index)
+            name = 'idx_' + table_h.convert_name(
+                '_'.join([table_h.table_name, name]), reserved=len('idx_'))
+            self.assertIn(name, table_h._indexes)
+
+    @with_transaction()
+    def test0070multi_company(self):
+        'Test output lots of productions of many companies.'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Production = pool.get('production')
+
+        company1 = create_company()
+        company2 = create_company('Company 2', currency=company1.currency)
+        productions = []
+        for company, creation, prefix in [
+                (company1, 'running', 'A'),
+                (company2, 'done', 'B'),
+                ]:
+            with set_company(company):
+                setup = create_output_lot_setup(
+                    company, creation=creation, prefix=prefix)
+                productions.extend(create_productions(setup, [[]]))
+
+        with set_company(company1):
+            self.assertEqual(
+                [(c, s.creation) for c, _, s in
+                    Production._get_output_lot_groups(productions)],
+                [(company1.id, 'running'), (company2.id, 'done')])
+            get_values = Move.get_production_output_lot_values
+
+            def get_production_output_lot_values(self, plan):
+                values = get_values(self, plan)
+                values['number'] += '-%s' % self.production_output.id
+                return values
+
+            # The lot values can be customized per output
+            with patch.object(Move, 'get_production_output_lot_values',
+                    get_production_output_lot_values):
+                Production.assign_output_lots(productions)
+            self.assertEqual(
+                [p.outputs[0].lot.number for p in productions],
+                ['A1-%s' % productions[0].id, 'B1-%s' % productions[1].id])
+
+    @with_transaction()
+    def test0075process_with_output_lots(self):
+        'Test run and do productions returning their output lots.'
+        pool = Pool()
+        Production = pool.get('production')
+
+        company = create_company()
+        with set_company(company):
+            setup = create_output_lot_setup(company)
+            productions = create_productions(setup, [[], []])
+            Production.wait(productions)
+            Production.assign(productions)
+
+            output_lots = Production.process_with_output_lots(
+                productions, 'run')
+            self.assertEqual([p.state for p in productions],
+                ['running', 'running'])
+            self.assertEqual(output_lots, {
+                    str(o.id): (o.lot.id, o.lot.number, None)
+                    for p in productions for o in p.outputs})
+            self.assertEqual(
+                sorted(n for _, n, _ in output_lots.values()), ['1', '2'])
+            # The result can be marshalled
+            xmlrpc.client.dumps((output_lots,), allow_none=True)
+
+            # The lots assigned before are returned
+            self.assertEqual(
+                Production.process_with_output_lots(productions, 'do'),
+                output_lots)
+            self.assertEqual([p.state for p in productions], ['done', 'done'])
+
+            # Only run and do can be called
+            with self.assertRaises(UserError):
+                Production.process_with_output_lots(productions, 'cancel')
+
+    @with_transaction()
+    def test0080query_counter(self):
+        'Test query counter only counts the queries of its connection.'
+        transaction = Transaction()
+
+        class Cursor:
+            def execute(self, query):
+                pass
+
+        class Connection:
+            cursor_factory = Cursor
+
+            def cursor(self):
+                return self.cursor_factory()
+
+        connection, other = Connection(), Connection()
+        sqlite_connection = transaction.connection
+        transaction.connection = connection
+        try:
+            with QueryCounter() as counter:
+                with QueryCounter() as nested:
+                    connection.cursor().execute('SELECT 1')
+                connection.cursor().execute('SELECT 2')
+                other.cursor().execute('SELECT 3')
+        finally:
+            transaction.connection = sqlite_connection
+        self.assertEqual((counter.count, nested.count), (2, 1))
+        self.assertIs(connection.cursor_factory, Cursor)
+        self.assertIs(other.cursor_factory, Cursor)
+
+        with QueryCounter() as counter:
+            transaction.connection.cursor().execute('SELECT 1')
+        self.assertEqual(counter.count, 1)
+
+    @with_transaction()
+    def test0085lock_outputs(self):
+        'Test outputs are locked by increasing id.'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Production = pool.get('production')
+        transaction = Transaction()
+
+        outputs = Move.browse([3, 1, 2])
+        # Nothing is locked without SELECT FOR UPDATE
+        self.assertEqual(Production._lock_outputs(outputs), [1, 2, 3])
+
+        queries = []
+
+        class Cursor:
+            def execute(self, query, params=None):
+                queries.append(query)
+
+            def __iter__(self):
+                # The output 2 is locked by another transaction
+                return iter([(1,), (3,)])
+
+        class ForSkipLocked(For):
+            def __str__(self):
+                return super().__str__() + ' SKIP LOCKED'
+
+        with patch.object(transaction.database, 'has_select_for',
+                    return_value=True), \
+                patch.object(transaction.database,
+                    'get_select_for_skip_locked',
+                    return_value=ForSkipLocked), \
+                patch.object(transaction, 'connection') as connection:
+            connection.cursor.return_value = Cursor()
+            self.assertEqual(
+                Production._lock_outputs(outputs, skip_locked=True), [1, 3])
+            Production._lock_outputs(outputs)
+        skip_locked, nowait = queries
+        self.assertTrue(skip_locked.endswith(
+                'ORDER BY "a"."id" ASC FOR UPDATE SKIP LOCKED'))
+        self.assertTrue(nowait.endswith(
+                'ORDER BY "a"."id" ASC FOR UPDATE NOWAIT'))
+
+    @with_transaction()
+    def test0090chunks(self):
+        'Test productions processed by committed chunks.'
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+        Production = pool.get('production')
+
+        company = create_company()
+        with set_company(company):
+            setup = create_output_lot_setup(company)
+            lot1, lot2, lot3, lot4 = Lot.create([{
+                        'number': 'IN%s' % i,
+                        'product': setup.input_product.id,
+                        } for i in range(1, 5)])
+            productions = create_productions(setup,
+                [[lot1], [lot2], [lot3, lot4], [lot4]], bom=setup.bom)
+            Production.wait(productions)
+            Production.assign(productions)
+            ids = [p.id for p in productions]
+            # The chunks are processed in other transactions
+            Transaction().commit()
+
+            def states():
+                with Transaction().new_transaction():
+                    return [p.state for p in Production.browse(ids)]
+
+            def output_lots():
+                with Transaction().new_transaction():
+                    return [p.outputs[0].lot.id if p.outputs[0].lot else None
+                        for p in Production.browse(ids)]
+
+            # Only the faulty production of the failed chunk is not processed
+            processed, failed = Production.process_by_chunks(
+                'run', productions, 2)
+            self.assertEqual(processed, [ids[0], ids[1], ids[3]])
+            self.assertEqual(list(failed), [ids[2]])
+            self.assertEqual(
+                states(), ['running', 'running', 'assigned', 'running'])
+            with self.assertRaises(UserError):
+                Production.run_by_chunks(Production.browse(ids), 2)
+
+            # Resume once the production is fixed
+            lots = output_lots()
+            self.assertEqual(lots[2], None)
+            Move.write([m for m in Production(ids[2]).inputs
+                    if m.lot == lot4], {'lot': None})
+            Transaction().commit()
+            Production.run_by_chunks(Production.browse(ids), 2)
+            self.assertEqual(states(), ['running'] * 4)
+            self.assertEqual(output_lots()[:2], lots[:2])
+            self.assertIsNotNone(output_lots()[2])
+
+            # The database errors are reported as failures
+            with patch.object(Production, 'check_output_lot_inputs',
+                    side_effect=backend.DatabaseOperationalError('locked')):
+                processed, failed = Production.process_by_chunks(
+                    'do', Production.browse(ids), 2)
+            self.assertEqual(processed, [])
+            self.assertEqual(failed, dict.fromkeys(ids, 'locked'))
+            Production.do_by_chunks(Production.browse(ids))
+            self.assertEqual(states(), ['done'] * 4)
+
+    @with_transaction()
+    def test0095missing_output_lots(self):
+        'Test create missing output lots of running productions.'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Production = pool.get('production')
+        Session = pool.get('ir.session.wizard')
+        CreateMissingOutputLots = pool.get(
+            'production.create_missing_output_lots', type='wizard')
+
+        company = create_company()
+        with set_company(company):
+            setup = create_output_lot_setup(company, creation='done')
+            productions = (create_productions(setup, [[]])
+                + create_productions(setup, [[]], outputs=2)
+                + create_productions(setup, [[], []]))
+            Production.wait(productions)
+            Production.assign(productions)
+            productions, pending = productions[:3], productions[3:]
+            Production.run(productions)
+            cancelled = productions[1].outputs[1]
+            Move.cancel([cancelled])
+            ids = [p.id for p in productions]
+            self.assertEqual(
+                Production._get_missing_output_lot_productions(), ids)
+            # The chunks are processed in other transactions
+            Transaction().commit()
+
+            def output_lots():
+                with Transaction().new_transaction():
+                    return [bool(o.lot) for p in Production.browse(ids)
+                        for o in p.outputs]
+
+            self.assertEqual(
+                Production.create_missing_output_lots(chunk_size=2), 3)
+            self.assertEqual(output_lots(), [True, True, False, True])
+            self.assertEqual(
+                Production.create_missing_output_lots(chunk_size=2), 0)
+
+            # The wizard reports the number of created lots
+            Production.run(pending)
+            Transaction().commit()
+            session = Session()
+            session.save()
+            wizard = CreateMissingOutputLots(session.id)
+            self.assertEqual(wizard.transition_create_(), 'done')
+            self.assertEqual(wizard.default_done(None), {'lots': 1})
+
+
+class ProductionOutputLotSLEDTestCase(ModuleTestCase):
+    'Test ProductionOutputLot module with stock_lot_sled'
+    module = 'production_output_lot'
+    extras = ['stock_lot_sled']
+
+    @with_transaction()
+    def test0010output_lot_dates(self):
+        'Test expiration dates of output lots.'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Lot = pool.get('stock.lot')
+        Production = pool.get('production')
+
+        company = create_company()
+        with set_company(company):
+            today = Date.today()
+            setup = create_output_lot_setup(company,
+                expiration_state='optional', expiration_time=10,
+                shelf_life_state='optional', shelf_life_time=5)
+            input_product = setup.input_product
+            output_product = setup.output_product
+            expiring_lot, drag_lot, other_lot = Lot.create([{
+                        'number': 'IN1',
+                        'product': input_product.id,
+                        'expiration_date': today + datetime.timedelta(days=3),
+                        }, {
+                        'number': 'IN2',
+                        'product': input_product.id,
+                        'expiration_date': today + datetime.timedelta(days=4),
+                        'shelf_life_expiration_date': (
+                            today + datetime.timedelta(days=2)),
+                        }, {
+                        'number': 'IN3',
+                        'product': input_product.id,
+                        }])
+            productions = (
+                create_productions(setup,
+                    [[expiring_lot, other_lot], [other_lot], []])
+                + create_productions(setup, [[drag_lot]], bom=setup.bom))
+
+            Production.assign_output_lots(productions)
+            self.assertEqual(
+                [(p.outputs[0].lot.expiration_date,
+                        p.outputs[0].lot.shelf_life_expiration_date)
+                    for p in productions], [
+                    # The earliest expiration date of the inputs
+                    (today + datetime.timedelta(days=3), None),
+                    # The default dates of the product
+                    (today + datetime.timedelta(days=10),
+                        today + datetime.timedelta(days=5)),
+                    (today + datetime.timedelta(days=10),
+                        today + datetime.timedelta(days=5)),
+                    # The dates of the dragged lot
+                    (today + datetime.timedelta(days=4),
+                        today + datetime.timedelta(days=2)),
+                    ])
+            self.assertEqual(
+                productions[0].outputs[0].get_production_output_lot(
+                    'OUT').expiration_date,
+                today + datetime.timedelta(days=3))
+
+            # The default dates are computed once per product
+            output = productions[2].outputs[0]
+            product_defaults = {}
+            dates = output._get_production_output_lot_dates(
+                None, product_defaults=product_defaults)
+            self.assertEqual(product_defaults, {output_product.id: dates})
+            product_defaults[output_product.id] = {'expiration_date': today}
+            self.assertEqual(output._get_production_output_lot_dates(
+                    None, product_defaults=product_defaults),
+                {'expiration_date': today})
+
+            # The reused lots keep their dates
+            setup.config.output_lot_reuse_drag_lot = True
+            setup.config.save()
+            new_lot, = Lot.create([{
+                        'number': 'IN4',
+                        'product': input_product.id,
+                        'expiration_date': today + datetime.timedelta(days=6),
+                        }])
+            productions = create_productions(setup,
+                [[drag_lot], [new_lot], [new_lot]], bom=setup.bom)
+            self.assertEqual(
+                [(p['expiration_date'], p['shelf_life_expiration_date'])
+                    for p in Production.preview_output_lots(productions)], [
+                    (today + datetime.timedelta(days=4),
+                        today + datetime.timedelta(days=2)),
+                    (today + datetime.timedelta(days=6), None),
+                    (today + datetime.timedelta(days=6), None),
+                    ])
+
 
 del ModuleTestCase